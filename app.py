@@ -1,14 +1,21 @@
 import challonge
 from collections import namedtuple
+import csv
 import datetime
 from dateutil import parser
 import json
+import math
 import os
 import re
 import slack
+import struct
+import sys
+import time
+import unicodedata
 
 from flask import Flask, request, Response
 from flask_slacksigauth import slack_sig_auth
+from slack.errors import SlackApiError
 import firebase_admin
 from firebase_admin import firestore
 
@@ -112,15 +119,20 @@ def try_id(name, ids):
 def try_num(f):
   return f'{f:.1f}' if f else '-'
 
+def division_doc(league, division):
+  return (db.collection('rankings')
+       .document(league)
+       .collection('divisions')
+       .document(division))
+
+def teams_collection(league, division):
+  return division_doc(league, division).collection('teams')
+
 def ranking(defn, other, rank_type, reverse):
   if defn.team == 'teams':
     return '\n'.join(sorted(
         f'{t.id}: {t.to_dict()["name"]}'
-        for t in  db.collection('rankings')
-                       .document(defn.league)
-                       .collection('divisions')
-                       .document(defn.division)
-                       .collection('teams').stream()))
+        for t in teams_collection(defn.league, defn.division).stream()))
   (pairs, previous) = get_rankings(defn, rank_type)
   if not pairs:
     return "Couldn't find ratings for {defn.team}"
@@ -142,6 +154,119 @@ def ranking(defn, other, rank_type, reverse):
           sort_ranked(pairs, reverse) +
           sort_unranked(pairs)])
 
+rank_types = ('pti', 'divtskill')
+
+max_batch = 500
+
+point = struct.Struct('<qd')
+
+def season_start(date):
+  return datetime.date(date.year if date.month > 6 else date.year - 1, 7, 1)
+
+def season(date):
+  start = season_start(date).year
+  return f'{start}-{(start + 1) % 100:02d}'
+
+def history_doc(league, division, team, season):
+  return (teams_collection(league, division)
+       .document(team)
+       .collection('history')
+       .document(season))
+
+def unpack_history(packed):
+  return list(point.iter_unpack(packed or b''))
+
+def rated(points):
+  return [(t, rating) for (t, rating) in points if not math.isnan(rating)]
+
+def history_update(history, current, incoming, now, start):
+  update = {}
+  for rank_type in rank_types:
+    if rank_type not in incoming:
+      continue
+    packed = dict(history.get(rank_type, {}))
+    previous = current.get(rank_type) or {}
+    ratings = incoming[rank_type]
+    for (name, rating) in ratings.items():
+      if name not in packed and previous.get(name) is not None:
+        packed[name] = point.pack(start, previous[name])
+      points = unpack_history(packed.get(name))
+      if rating is None or (points and points[-1][1] == rating):
+        continue
+      packed[name] = packed.get(name, b'') + point.pack(now, rating)
+    for (name, points) in packed.items():
+      if (ratings.get(name) is None and
+          not math.isnan(point.unpack(points[-point.size:])[1])):
+        packed[name] = points + point.pack(now, math.nan)
+    if packed != history.get(rank_type, {}):
+      update[rank_type] = packed
+  return update
+
+def rank_history(histories, reverse):
+  events = sorted((t, name, rating)
+                  for (name, points) in histories.items()
+                  for (t, rating) in points)
+  latest = {}
+  ranks = {name: [] for name in histories}
+  for (i, (t, name, rating)) in enumerate(events):
+    if math.isnan(rating):
+      latest.pop(name, None)
+    else:
+      latest[name] = rating
+    if i + 1 < len(events) and events[i + 1][0] == t:
+      continue
+    ranked = sort_ranked(latest.items(), reverse)
+    for (rank, (ranked_name, _)) in enumerate(ranked, 1):
+      if not ranks[ranked_name] or ranks[ranked_name][-1] != rank:
+        ranks[ranked_name].append(rank)
+  return ranks
+
+sparks = '▁▂▃▄▅▆▇█'
+
+def sparkline(ratings, width=20):
+  ratings = ratings[-width:]
+  (low, high) = (min(ratings), max(ratings))
+  if high == low:
+    return sparks[len(sparks) // 2] * len(ratings)
+  return ''.join(sparks[round((r - low) / (high - low) * (len(sparks) - 1))]
+                 for r in ratings)
+
+def try_delta(points):
+  return f'{points[-1][1] - points[0][1]:+.1f}' if len(points) > 1 else '-'
+
+def find_player(name, names):
+  matches = [n for n in names if n.lower() == name.lower()]
+  if not matches:
+    matches = [n for n in names if name.lower() in n.lower()]
+  return matches[0] if len(matches) == 1 else None
+
+def trend(defn, name, rank_type, reverse):
+  current_season = season(datetime.date.today())
+  history = history_doc(defn.league, defn.division, defn.team, current_season).get()
+  if not history.exists:
+    return f'No {current_season} history for {defn.team}'
+  histories = {n: unpack_history(packed)
+               for (n, packed) in history.to_dict().get(rank_type, {}).items()}
+  ranks = rank_history(histories, reverse)
+  if name:
+    player = find_player(name, histories)
+    if not player:
+      return f"Couldn't find a single player matching {name} on {defn.team}"
+    points = rated(histories[player])
+    return '\n'.join([
+        f'*{player}* {rank_type} in {current_season}: ' +
+        ' → '.join([try_num(points[0][1]), try_num(points[-1][1])]) +
+        f' ({try_delta(points)})' +
+        (' (not currently rated)' if math.isnan(histories[player][-1][1]) else ''),
+        sparkline([rating for (_, rating) in points]),
+        'Rank: ' + ' → '.join([str(r) for r in ranks[player]])])
+  latest = [(n, points[-1][1]) for (n, points) in histories.items()
+            if not math.isnan(points[-1][1])]
+  return '\n'.join([f'{defn.team} {rank_type} in {current_season}:'] + [
+      f'{ranks[n][-1]}. {n}, {try_num(rating)} ({try_delta(rated(histories[n]))}) '
+      f'{sparkline([r for (_, r) in rated(histories[n])])}'
+      for (n, rating) in sort_ranked(latest, reverse)])
+
 @app.route("/pti", methods=['POST'])
 @slack_sig_auth
 def pti():
@@ -149,6 +274,8 @@ def pti():
   defn = team_definition(request.form['channel_id'])
   if not defn:
     return f'No team associated with <@{request.form["channel_id"]}>'
+  if parts and parts[0] == 'trend':
+    return ephemeral(trend(defn, ' '.join(parts[1:]), 'pti', False))
   other = None
   if len(parts) > 1 and parts[-2] == 'vs':
     other = parts.pop()
@@ -171,6 +298,8 @@ def rank():
   defn = team_definition(request.form['channel_id'])
   if not defn:
     return f'No team associated with <@{request.form["channel_id"]}>'
+  if parts and parts[0] == 'trend':
+    return ephemeral(trend(defn, ' '.join(parts[1:]), 'divtskill', True))
   other = None
   if len(parts) > 1 and parts[-2] == 'vs':
     other = parts.pop()
@@ -705,5 +834,175 @@ def tourney():
   method = post if show else ephemeral
   return method(f'{played} matches played in the D7 tournament', blocks)
 
+rating_kinds = ('csv', 'json', 'jsonl')
+
+def parse_rating(value):
+  if value is None or value == '':
+    return None
+  return float(value)
+
+def read_ratings(f, kind):
+  if kind == 'csv':
+    yield from csv.DictReader(f)
+  elif kind == 'json':
+    yield from json.load(f)
+  else:
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+
+def group_ratings(rows):
+  divisions = {}
+  for row in rows:
+    team = (divisions.setdefault(row['division'], {})
+                     .setdefault(row['team'], {}))
+    if row.get('name'):
+      team['name'] = row['name']
+    for rank_type in rank_types:
+      if rank_type not in row:
+        continue
+      try:
+        rating = parse_rating(row[rank_type])
+      except ValueError:
+        raise ValueError(
+            f'Bad {rank_type} {row[rank_type]!r} for {row["player"]} '
+            f'on {row["division"]}/{row["team"]}')
+      team.setdefault(rank_type, {})[row['player']] = rating
+  return divisions
+
+def rating_update(team, current, incoming, now):
+  update = {}
+  name = incoming.get('name', current.get('name', team))
+  if name != current.get('name'):
+    update['name'] = name
+  for rank_type in rank_types:
+    if rank_type not in incoming:
+      continue
+    previous = current.get(rank_type)
+    if previous == incoming[rank_type]:
+      continue
+    update[rank_type] = incoming[rank_type]
+    if previous:
+      update[f'previous_{rank_type}'] = previous
+      update[f'previous_{rank_type}_time'] = now
+  return update
+
+def commit_writes(groups):
+  batch = db.batch()
+  pending = 0
+  for writes in groups:
+    if pending + len(writes) > max_batch:
+      batch.commit()
+      batch = db.batch()
+      pending = 0
+    for (ref, value, exists) in writes:
+      (batch.update if exists else batch.set)(ref, value)
+    pending += len(writes)
+  if pending:
+    batch.commit()
+
+def ingest(league, rows):
+  today = datetime.date.today()
+  now = int(datetime.datetime.now().timestamp() * 1000)
+  start = int(datetime.datetime.combine(season_start(today), datetime.time())
+              .timestamp() * 1000)
+  current_season = season(today)
+  groups = []
+  changed = 0
+  for (division, teams) in group_ratings(rows).items():
+    collection = teams_collection(league, division)
+    current = {t.id: t.to_dict() for t in collection.stream()}
+    histories = {
+        h.reference.parent.parent.id: h
+        for h in db.get_all([history_doc(league, division, team, current_season)
+                             for team in teams])}
+    for (team, incoming) in teams.items():
+      writes = []
+      update = rating_update(team, current.get(team, {}), incoming, now)
+      if update:
+        changed += 1
+        writes.append((collection.document(team), update, team in current))
+      history = histories[team]
+      update = history_update(history.to_dict() or {}, current.get(team, {}),
+                              incoming, now, start)
+      if update:
+        writes.append((history.reference, update, history.exists))
+      if writes:
+        groups.append(writes)
+  commit_writes(groups)
+  return (f'Updated {changed} teams in {league} '
+          f'({sum(len(writes) for writes in groups)} writes)')
+
+def normalize_name(name):
+  name = unicodedata.normalize('NFKD', name)
+  return ''.join(c for c in name.lower() if c.isalnum())
+
+def roster_index():
+  index = {}
+  for team in db.collection_group('teams').stream():
+    value = team.to_dict()
+    for rank_type in rank_types:
+      for name in value.get(rank_type) or {}:
+        index.setdefault(normalize_name(name), set()).add(name)
+  return index
+
+def slack_members():
+  cursor = None
+  while True:
+    try:
+      response = client.users_list(limit=200, **({'cursor': cursor} if cursor else {}))
+    except SlackApiError as e:
+      if e.response.status_code != 429:
+        raise
+      time.sleep(int(e.response.headers.get('Retry-After', 1)))
+      continue
+    yield from response['members']
+    cursor = response.get('response_metadata', {}).get('next_cursor')
+    if not cursor:
+      return
+
+def sync_names():
+  index = roster_index()
+  matched = {}
+  ambiguous = set()
+  active = set()
+  for member in slack_members():
+    if member.get('deleted') or member.get('is_bot') or member['id'] == 'USLACKBOT':
+      continue
+    active.add(member['id'])
+    profile = member.get('profile', {})
+    keys = {normalize_name(n)
+            for n in (profile.get('display_name'), profile.get('real_name'),
+                      member.get('real_name'))
+            if n}
+    for name in set().union(*[index.get(key, set()) for key in keys]):
+      if matched.get(name, member['id']) != member['id']:
+        ambiguous.add(name)
+      matched[name] = member['id']
+  doc = db.document('slack/names')
+  ids = (doc.get().to_dict() or {}).get('ids', {})
+  changed = {name: id for (name, id) in matched.items()
+             if name not in ambiguous
+             and ids.get(name) != id
+             and ids.get(name) not in active}
+  if changed:
+    doc.set({ 'ids': changed }, merge=True)
+  return f'Updated {len(changed)} Slack ids ({len(ambiguous)} ambiguous names skipped)'
+
 if __name__ == "__main__":
+  if sys.argv[1:2] == ['ingest']:
+    kind = sys.argv[-1].rsplit('.', 1)[-1].lower()
+    if len(sys.argv) != 4 or kind not in rating_kinds:
+      sys.exit(f'Usage: {sys.argv[0]} ingest <league> <file.csv|file.json|file.jsonl>')
+    (league, path) = sys.argv[2:]
+    with open(path, newline='') as f:
+      try:
+        print(ingest(league, read_ratings(f, kind)))
+      except ValueError as e:
+        sys.exit(str(e))
+  elif sys.argv[1:2] == ['sync-names']:
+    if len(sys.argv) != 2:
+      sys.exit(f'Usage: {sys.argv[0]} sync-names')
+    print(sync_names())
+  else:
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))